@@ -19,6 +19,8 @@ from netbox2ise.utils.cli_utils import (
     get_desired_devices,
     lookup_current_ise_config,
     generate_desired_ise_config,
+    collect_desired_ise_config,
+    collect_current_and_desired_ise_config,
     diff_configs,
     print_group_diff,
     print_devices_diff,
@@ -79,27 +81,13 @@ def sync(data_file, remove_extra, debug):
 
     console.rule(f"[bold black] Calculating Diffs", align="left")
 
-    # Get Current ISE Devices and Groups
-    current_devices, current_groups = lookup_current_ise_config(
-        datafile["defaults"]["ise_server"], debug=debug
-    )
-
-    # Get Desired ISE Devices and Groups
-    # Create variables for desired devices and groups that will contain info from all jobs
-    desired_devices = {}
-    desired_groups = set()
-
-    # Process each job in the jobs list from the data file
-    for job in datafile["jobs"]:
-        console.rule(
-            f'[bold black]  * Working on job {job["name"]}',
-            align="left",
-        )
-        job_desired_devices, job_desired_groups = generate_desired_ise_config(
-            datafile["defaults"]["netbox_server"], job, debug
-        )
-        desired_devices.update(job_desired_devices)
-        desired_groups.update(job_desired_groups)
+    # Get Current and Desired ISE Devices and Groups
+    (
+        current_devices,
+        current_groups,
+        desired_devices,
+        desired_groups,
+    ) = collect_current_and_desired_ise_config(datafile, debug)
 
     # Generate diffs
     devices_diff, groups_diff = diff_configs(
@@ -121,32 +109,16 @@ def sync(data_file, remove_extra, debug):
     )
     if debug:
         console.log(f"groups_sync: {groups_sync}")
-    # Print the sync results table if there were updates made
-    if (
-        len(groups_sync["updated"].values())
-        + len(groups_sync["created"].values())
-        + len(groups_sync["deleted"].values())
-        > 0
-    ):
-        print_group_sync(groups_sync)
-    else:
-        rprint("   [grey]No changes to Network Device Groups made.")
+    # Print the sync results table (or a note if no updates were made)
+    print_group_sync(groups_sync)
 
     console.rule(f"[bold black] Syncing Network Devices", align="left")
     devices_sync = sync_devices(
         datafile["defaults"]["ise_server"], devices_diff, debug=debug
     )
 
-    # Print the sync results table if there were updates made
-    if (
-        len(devices_sync["updated"].values())
-        + len(devices_sync["created"].values())
-        + len(devices_sync["deleted"].values())
-        > 0
-    ):
-        print_devices_sync(devices_sync)
-    else:
-        rprint("   [grey]No changes to Network Devices made.")
+    # Print the sync results table (or a note if no updates were made)
+    print_devices_sync(devices_sync)
 
 
 @click.command()
@@ -180,29 +152,16 @@ def verify(data_file, display_group_diff, debug):
         f'[bold black]Looking up Current Devices and Groups from ISE Server {datafile["defaults"]["ise_server"]["address"]}',
         align="left",
     )
-    current_devices, current_groups = lookup_current_ise_config(
-        datafile["defaults"]["ise_server"], debug=debug
-    )
-
     console.rule(
         "[bold black]Generating Desired ISE Configuration from NetBox", align="left"
     )
 
-    # Create variables for desired devices and groups that will contain info from all jobs
-    desired_devices = {}
-    desired_groups = set()
-
-    # Process each job in the jobs list from the data file
-    for job in datafile["jobs"]:
-        console.rule(
-            f'[bold black]* Building Desired Devices Configurations for job {job["name"]}',
-            align="left",
-        )
-        job_desired_devices, job_desired_groups = generate_desired_ise_config(
-            datafile["defaults"]["netbox_server"], job, debug
-        )
-        desired_devices.update(job_desired_devices)
-        desired_groups.update(job_desired_groups)
+    (
+        current_devices,
+        current_groups,
+        desired_devices,
+        desired_groups,
+    ) = collect_current_and_desired_ise_config(datafile, debug)
 
     console.rule(
         f"[bold black]* Determining Diffs between Current and Desired Configurations",
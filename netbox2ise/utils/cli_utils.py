@@ -1,8 +1,12 @@
 from os import getenv
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import chain
 import yaml
 import json
+import re
 
-from rich.console import Console
+from rich.console import Console, Group
 from rich.table import Table
 from rich import print as rprint
 
@@ -12,7 +16,6 @@ from netbox2ise.utils.ise import verify_ise, lookup_ise_devices, lookup_groups
 # from netbox2ise.utils.ise import lookup_groups, sync_groups, lookup_ise_devices
 
 from netbox2ise.utils.conversion import (
-    set_of_ise_groups,
     diff_ise_groups,
     diff_ise_devices,
 )
@@ -25,6 +28,27 @@ from netbox2ise.utils.conversion import ise_device_from_netbox
 
 console = Console()
 
+# Use the libyaml based loader when PyYAML was built with it
+Loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+# Table colors for each diff and sync status
+_DIFF_COLORS = {
+    "correct": "blue",
+    "incorrect": "#F39C12",
+    "missing": "red",
+    "extra": "purple",
+}
+_SYNC_COLORS = {
+    "created": "blue",
+    "updated": "#F39C12",
+    "deleted": "red",
+}
+
+# Markup for each group status in the devices diff table
+_DIFF_TAGS = {
+    status: (f"[{style}]", f"[/{style}]") for status, style in _DIFF_COLORS.items()
+}
+
 
 def test_datafile(data_file):
     """
@@ -33,63 +57,62 @@ def test_datafile(data_file):
     """
 
     errors = []
-    with open(data_file) as f:
-        yaml_datafile = yaml.safe_load(f.read())
+    # Opened as binary so the loader reads and decodes the file itself
+    with open(data_file, "rb") as f:
+        yaml_datafile = yaml.load(f, Loader=Loader)
 
     # NetBox and ISE Servers
     console.rule("[bold black]Checking NetBox and ISE Servers", align="left")
-    defaults = yaml_datafile["defaults"] if yaml_datafile.get("defaults") else None
+    defaults = yaml_datafile.get("defaults")
     if defaults:
-        netbox_server = (
-            defaults["netbox_server"] if defaults.get("netbox_server") else None
-        )
-        if netbox_server:
-            # Read token from ENV if not in data-file
-            netbox_server["token"] = (
-                netbox_server["token"]
-                if netbox_server.get("token")
-                else getenv("NETBOX_TOKEN")
-            )
-
-            # Attempt to connect to the netbox server
-            netbox_test = verify_netbox(netbox_server)
-            if netbox_test["status"]:
-                rprint(
-                    f"[blue]NetBox Server {netbox_server['url']} successfully connected to."
+        # The NetBox and ISE Servers are independent, verify them at the same time
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            netbox_server = defaults.get("netbox_server")
+            if netbox_server:
+                # Read token from ENV if not in data-file
+                netbox_server["token"] = netbox_server.get("token") or getenv(
+                    "NETBOX_TOKEN"
                 )
+
+                # Attempt to connect to the netbox server
+                netbox_test = executor.submit(verify_netbox, netbox_server)
             else:
-                rprint(
-                    f"[red]Problem connecting to NetBox Server {netbox_server['url']}."
-                )
-        else:
-            errors.append("netbox_server data is missing.")
-
-        ise_server = defaults["ise_server"] if defaults.get("ise_server") else None
-        if ise_server:
-            # Read user/pass from ENV if not in data-file
-            ise_server["username"] = (
-                ise_server["username"]
-                if ise_server.get("username")
-                else getenv("ISE_USER")
-            )
-            ise_server["password"] = (
-                ise_server["password"]
-                if ise_server.get("password")
-                else getenv("ISE_PASS")
-            )
+                errors.append("netbox_server data is missing.")
 
-            # Attempt to conenct to ise server
-            ise_test = verify_ise(ise_server)
-            if ise_test["status"]:
-                rprint(
-                    f"[blue]ISE Server {ise_server['address']} successfully connected to."
+            ise_server = defaults.get("ise_server")
+            if ise_server:
+                # Read user/pass from ENV if not in data-file
+                ise_server["username"] = ise_server.get("username") or getenv(
+                    "ISE_USER"
                 )
-            else:
-                rprint(
-                    f"[red]Problem connecting to ISE Server {ise_server['address']}."
+                ise_server["password"] = ise_server.get("password") or getenv(
+                    "ISE_PASS"
                 )
-        else:
-            errors.append("ise_server data is missing.")
+
+                # Attempt to conenct to ise server
+                ise_test = executor.submit(verify_ise, ise_server)
+            else:
+                errors.append("ise_server data is missing.")
+
+            if netbox_server:
+                if netbox_test.result()["status"]:
+                    rprint(
+                        f"[blue]NetBox Server {netbox_server['url']} successfully connected to."
+                    )
+                else:
+                    rprint(
+                        f"[red]Problem connecting to NetBox Server {netbox_server['url']}."
+                    )
+
+            if ise_server:
+                if ise_test.result()["status"]:
+                    rprint(
+                        f"[blue]ISE Server {ise_server['address']} successfully connected to."
+                    )
+                else:
+                    rprint(
+                        f"[red]Problem connecting to ISE Server {ise_server['address']}."
+                    )
     else:
         errors.append("defaults section of data-file not found.")
 
@@ -102,29 +125,27 @@ def test_datafile(data_file):
     return yaml_datafile
 
 
-def get_desired_devices(netbox_server, job, debug=False):
+def get_desired_devices(netbox_server, job, debug=False, desired_groups=None):
     """
     Return a desired_devices list from a NetBox server for a 'job'
+
+    :param desired_groups: An optional set, updated with the ISE groups of every desired device
     """
 
+    netbox_query = job["netbox_query"]
     netbox_devices = lookup_nb_devices(
         netbox_server=netbox_server,
-        sites=job["netbox_query"]["sites"] if job["netbox_query"].get("sites") else [],
-        device_types=job["netbox_query"]["device_types"]
-        if job["netbox_query"].get("device_types")
-        else [],
-        device_roles=job["netbox_query"]["device_roles"]
-        if job["netbox_query"].get("device_roles")
-        else [],
-        tenants=job["netbox_query"]["tenants"]
-        if job["netbox_query"].get("tenants")
-        else [],
-        status=job["netbox_query"]["status"]
-        if job["netbox_query"].get("status")
-        else [],
+        sites=netbox_query.get("sites") or [],
+        device_types=netbox_query.get("device_types") or [],
+        device_roles=netbox_query.get("device_roles") or [],
+        tenants=netbox_query.get("tenants") or [],
+        status=netbox_query.get("status") or [],
         debug=debug,
     )
     if debug:
+        # The devices and vms are streamed from NetBox, keep them to loop over again below
+        netbox_devices["devices"] = list(netbox_devices["devices"])
+        netbox_devices["vms"] = list(netbox_devices["vms"])
         console.log(f"job: {job['name']}")
         console.log(
             f"netbox devices: {', '.join( [ device.name for device in netbox_devices['devices'] ])}"
@@ -133,30 +154,24 @@ def get_desired_devices(netbox_server, job, debug=False):
             f"netbox vms: {', '.join( [ vm.name for vm in netbox_devices['vms'] ])}"
         )
 
+    # The same TACACS and RADIUS secrets are used for every device in the job
+    ise_config = job["ise_config"]
+    tacacs_secret = (ise_config.get("tacacs") or {}).get("secret")
+    radius_secret = (ise_config.get("radius") or {}).get("secret")
+
     # create the desired ise-device configurations for the netbox-quere
     desired_devices = {}
-    for device in netbox_devices["devices"]:
-        desired_devices[device["name"]] = ise_device_from_netbox(
+    for device in chain(netbox_devices["devices"], netbox_devices["vms"]):
+        ise_device = ise_device_from_netbox(
             device,
-            tacacs_secret=job["ise_config"]["tacacs"]["secret"]
-            if job["ise_config"].get("tacacs")
-            else None,
-            radius_secret=job["ise_config"]["radius"]["secret"]
-            if job["ise_config"].get("radius")
-            else None,
-            debug=debug,
-        )
-    for vm in netbox_devices["vms"]:
-        desired_devices[vm["name"]] = ise_device_from_netbox(
-            vm,
-            tacacs_secret=job["ise_config"]["tacacs"]["secret"]
-            if job["ise_config"].get("tacacs")
-            else None,
-            radius_secret=job["ise_config"]["radius"]["secret"]
-            if job["ise_config"].get("radius")
-            else None,
+            tacacs_secret=tacacs_secret,
+            radius_secret=radius_secret,
             debug=debug,
         )
+        desired_devices[device["name"]] = ise_device
+        # Collect the groups in the same pass rather than looping over the devices again
+        if desired_groups is not None:
+            desired_groups.update(ise_device["NetworkDeviceGroupList"])
 
     return desired_devices
 
@@ -169,16 +184,41 @@ def lookup_current_ise_config(ise_server, debug):
     :return (current_devices, current_groups)
     """
 
-    current_devices = lookup_ise_devices(ise_server, debug=debug)
+    # Devices and groups are independent lookups, run them at the same time
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        devices_lookup = executor.submit(lookup_ise_devices, ise_server, debug=debug)
+        groups_lookup = executor.submit(lookup_groups, ise_server, debug=debug)
+        current_devices = devices_lookup.result()
+        current_groups = groups_lookup.result()
+
     if debug:
         console.log(f"current_devices: {current_devices}")
-    current_groups = lookup_groups(ise_server, debug=debug)
-    if debug:
         console.log(f"current_groups: {current_groups}")
 
     return (current_devices, current_groups)
 
 
+def collect_current_and_desired_ise_config(datafile, debug=False):
+    """
+    Lookup the current ISE configuration while the desired configuration is
+    generated from NetBox.
+
+    :param datafile: The data-file contents returned from test_datafile
+    :return (current_devices, current_groups, desired_devices, desired_groups)
+    """
+
+    # ISE and NetBox are separate servers, look up ISE in the background rather
+    # than waiting for it before starting on NetBox
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        current_lookup = executor.submit(
+            lookup_current_ise_config, datafile["defaults"]["ise_server"], debug=debug
+        )
+        desired_devices, desired_groups = collect_desired_ise_config(datafile, debug)
+        current_devices, current_groups = current_lookup.result()
+
+    return (current_devices, current_groups, desired_devices, desired_groups)
+
+
 def generate_desired_ise_config(netbox_server, job, debug):
     """
     Generate desired configuration for ISE from NetBox Job
@@ -187,16 +227,43 @@ def generate_desired_ise_config(netbox_server, job, debug):
     :return (desired_devices, desired_groups)
     """
 
-    desired_devices = get_desired_devices(netbox_server, job, debug=debug)
+    desired_groups = set()
+    desired_devices = get_desired_devices(
+        netbox_server, job, debug=debug, desired_groups=desired_groups
+    )
     if debug:
         console.log(f"desired_devices: {desired_devices}")
-    desired_groups = set_of_ise_groups(desired_devices.values())
-    if debug:
         console.log(f"desired_groups: {desired_groups}")
 
     return (desired_devices, desired_groups)
 
 
+def collect_desired_ise_config(datafile, debug=False):
+    """
+    Generate the desired ISE devices and groups for every job in the data-file.
+
+    :param datafile: The data-file contents returned from test_datafile
+    :return (desired_devices, desired_groups)
+    """
+
+    # Devices and groups from each job are merged into a single desired configuration
+    desired_devices = {}
+    desired_groups = set()
+
+    for job in datafile["jobs"]:
+        console.rule(
+            f'[bold black]* Building Desired Devices Configurations for job {job["name"]}',
+            align="left",
+        )
+        job_desired_devices, job_desired_groups = generate_desired_ise_config(
+            datafile["defaults"]["netbox_server"], job, debug
+        )
+        desired_devices.update(job_desired_devices)
+        desired_groups |= job_desired_groups
+
+    return (desired_devices, desired_groups)
+
+
 def diff_configs(
     current_devices=None,
     desired_devices=None,
@@ -244,12 +311,10 @@ def print_group_diff(groups_diff):
     :param groups_diff:
     """
 
-    colors = {
-        "correct": "blue",
-        "incorrect": "#F39C12",
-        "missing": "red",
-        "extra": "purple",
-    }
+    # Skip building an empty table
+    if not groups_diff or not any(groups_diff.values()):
+        rprint("   [grey]No Network Device Group differences to display.")
+        return
 
     # Print table of desired devices
     table = Table(
@@ -259,10 +324,9 @@ def print_group_diff(groups_diff):
     table.add_column("Status", justify="left", no_wrap=True)
 
     for status in groups_diff:
+        style = _DIFF_COLORS.get(status, "black")
         for group in groups_diff[status]:
-            table.add_row(
-                group, status, style=colors[status] if colors.get(status) else "black"
-            )
+            table.add_row(group, status, style=style)
 
     console.print(table)
 
@@ -274,12 +338,10 @@ def print_devices_diff(devices_diff):
     :param devices_diff:
     """
 
-    colors = {
-        "correct": "blue",
-        "incorrect": "#F39C12",
-        "missing": "red",
-        "extra": "purple",
-    }
+    # Skip building an empty table
+    if not devices_diff or not any(devices_diff.values()):
+        rprint("   [grey]No Network Device differences to display.")
+        return
 
     # Print table of desired devices
     table = Table(title="Network Device Differences", show_lines=True, expand=True)
@@ -292,29 +354,22 @@ def print_devices_diff(devices_diff):
 
     for status in devices_diff:
         total_devices += len(devices_diff[status])
+        style = _DIFF_COLORS.get(status, "black")
         for device_name, diff_details in devices_diff[status].items():
             # Field Changes
             if status == "incorrect":
-                if diff_details["changes"]:
+                device_changes = diff_details["changes"]
+                if device_changes:
                     changes = []
 
                     # Look for any added items
-                    dictionary_item_added = (
-                        diff_details["changes"]["dictionary_item_added"]
-                        if "dictionary_item_added" in diff_details["changes"].keys()
-                        else list()
-                    )
-                    for added_item in dictionary_item_added:
+                    for added_item in device_changes.get("dictionary_item_added", ()):
                         changes.append(
                             f"[red]New Configuration under {added_item}[/red]"
                         )
 
                     # Look for any changed values
-                    values_changed = (
-                        diff_details["changes"]["values_changed"]
-                        if "values_changed" in diff_details["changes"].keys()
-                        else dict()
-                    )
+                    values_changed = device_changes.get("values_changed", {})
                     for field, change in values_changed.items():
                         changes.append(
                             f'[black]{field}[/black] \n  from [red]{change["old_value"]}[/red] \n  to [blue]{change["new_value"]}[/blue]'
@@ -336,24 +391,22 @@ def print_devices_diff(devices_diff):
             if status != "correct":
                 for group_status, groups in diff_details["group_changes"].items():
                     if len(groups) > 0:
-                        group_changes.append(
-                            f"[{colors[group_status]}]{group_status}[/{colors[group_status]}]"
+                        open_tag, close_tag = _DIFF_TAGS[group_status]
+                        group_changes.append(f"{open_tag}{group_status}{close_tag}")
+                        group_changes.extend(
+                            f"{open_tag} - {group}{close_tag}" for group in groups
                         )
-                        for group in groups:
-                            group_changes.append(
-                                f"[{colors[group_status]}] - {group}[/{colors[group_status]}]"
-                            )
 
             table.add_row(
                 device_name,
                 status,
                 changes,
                 "\n".join(group_changes),
-                style=colors[status] if colors.get(status) else "black",
+                style=style,
             )
 
-    console.print(table)
-    console.print(f"Total Devices: {total_devices}")
+    # Render the table and total together in a single print
+    console.print(Group(table, f"Total Devices: {total_devices}"))
 
 
 def print_group_sync(groups_sync):
@@ -363,11 +416,10 @@ def print_group_sync(groups_sync):
     :param groups_sync:
     """
 
-    colors = {
-        "created": "blue",
-        "updated": "#F39C12",
-        "deleted": "red",
-    }
+    # Skip building an empty table
+    if not groups_sync or not any(groups_sync.values()):
+        rprint("   [grey]No changes to Network Device Groups made.")
+        return
 
     # Print table of desired devices
     table = Table(
@@ -377,14 +429,39 @@ def print_group_sync(groups_sync):
     table.add_column("Status", justify="left", no_wrap=True)
 
     for status in groups_sync:
+        style = _SYNC_COLORS.get(status, "black")
         for group in groups_sync[status]:
-            table.add_row(
-                group, status, style=colors[status] if colors.get(status) else "black"
-            )
+            table.add_row(group, status, style=style)
 
     console.print(table)
 
 
+_DESCRIPTION_RE = re.compile(r'"description"\s*:\s*"((?:[^"\\]|\\.)*)"')
+
+
+@lru_cache(maxsize=256)
+def _parse_description(value):
+    """
+    Return the description from the JSON string ISE reports for an updated
+    Description field. Cached as many devices share the same values.
+
+    :param value: JSON string from the ERS API ie '{"description":"NEW", ...}'
+    :return description
+    """
+
+    # Pull out only the description rather than decoding the whole JSON object
+    match = _DESCRIPTION_RE.search(value)
+    if not match:
+        return json.loads(value)["description"]
+
+    description = match.group(1)
+    # Only escaped values need to be decoded
+    if "\\" in description:
+        description = json.loads(f'"{description}"')
+
+    return description
+
+
 def print_devices_sync(devices_sync):
     """
     Print a nice table displaying the devices_sync
@@ -392,11 +469,10 @@ def print_devices_sync(devices_sync):
     :param devices_sync:
     """
 
-    colors = {
-        "created": "blue",
-        "updated": "#F39C12",
-        "deleted": "red",
-    }
+    # Skip building an empty table
+    if not devices_sync or not any(devices_sync.values()):
+        rprint("   [grey]No changes to Network Devices made.")
+        return
 
     # Print table of desired devices
     table = Table(title="Network Devices Sync Results", show_lines=True, expand=True)
@@ -405,6 +481,7 @@ def print_devices_sync(devices_sync):
     table.add_column("Results", justify="left", no_wrap=False)
 
     for status in devices_sync:
+        style = _SYNC_COLORS.get(status, "black")
         for device, updates in devices_sync[status].items():
             # Build appropriate results string for table
             if status == "created":
@@ -423,8 +500,8 @@ def print_devices_sync(devices_sync):
                     # NOTE: This could cause problems with newer versions of ISE without this bug
                     # TODO: Test with different versions of ISE
                     if field["field"] == "Description":
-                        field["oldValue"] = json.loads(field["oldValue"])["description"]
-                        field["newValue"] = json.loads(field["newValue"])["description"]
+                        field["oldValue"] = _parse_description(field["oldValue"])
+                        field["newValue"] = _parse_description(field["newValue"])
 
                     # Some fields (like Groups and IP addresses) are split across 2 messages
                     old_message = (
@@ -445,7 +522,7 @@ def print_devices_sync(devices_sync):
                 device,
                 status,
                 result,
-                style=colors[status] if colors.get(status) else "black",
+                style=style,
             )
 
     console.print(table)
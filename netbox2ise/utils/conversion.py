@@ -4,9 +4,15 @@ ready for insertion/checks with Cisco ISE.
 """
 
 import pynetbox
-from deepdiff import DeepDiff
+from operator import attrgetter
 import re
 
+# Characters unsupported in ISE names: change / -> - and remove ()
+_ISE_NAME_TABLE = str.maketrans({"/": "-", "(": None, ")": None})
+
+# Description given to every ISE device, followed by the NetBox url of the device
+_NB_DESC_PREFIX = "From NetBox: "
+
 
 def ise_name_cleanup(name):
     """
@@ -16,13 +22,8 @@ def ise_name_cleanup(name):
     :return cleaned_name
     """
 
-    # change / -> -
-    name = name.replace("/", "-")
-
-    # remove ()
-    name = name.replace("(", "").replace(")", "")
-
-    return name
+    # NOTE: A single translate pass rather than a chain of str.replace calls
+    return name.translate(_ISE_NAME_TABLE)
 
 
 def ise_device_from_netbox(device, debug=False, tacacs_secret=None, radius_secret=None):
@@ -40,7 +41,7 @@ def ise_device_from_netbox(device, debug=False, tacacs_secret=None, radius_secre
 
     ise_device = {
         "name": device.name,
-        "description": f"From NetBox: {device.url}",
+        "description": _NB_DESC_PREFIX + device.url,
         "profileName": "Cisco",
         "coaPort": 1700,
         "NetworkDeviceIPList": [
@@ -49,7 +50,9 @@ def ise_device_from_netbox(device, debug=False, tacacs_secret=None, radius_secre
                 "mask": 32,
             }
         ],
-        "NetworkDeviceGroupList": ise_groups_from_netbox(device, debug=debug),
+        "NetworkDeviceGroupList": ise_groups_from_netbox(
+            device, debug=debug, kind=_netbox_device_kind(device)
+        ),
     }
 
     # Configure TACACS if provided
@@ -78,84 +81,200 @@ def ise_device_from_netbox(device, debug=False, tacacs_secret=None, radius_secre
     return ise_device
 
 
-def ise_groups_from_netbox(device, debug=False):
+# Attribute chains read from every NetBox device
+_GET_SITE = attrgetter("site.name")
+_GET_MANUF = attrgetter("device_type.manufacturer.name")
+_GET_MODEL = attrgetter("device_type.model")
+_GET_ROLE = attrgetter("device_role.name")
+
+
+# Builders for the groups that differ between devices and vms
+def _device_location_group(device):
+    """
+    Build the Location group for a device, based on its Site and Rack.
+
+    :param device: A NetBox pynetbox.models.dcim.Devices
+    :return Location group name
+    """
+
+    return "Location#All Locations{site}{rack}".format(
+        site=f"#{_GET_SITE(device)}",
+        rack=f"#{ise_name_cleanup(device.rack.name)}" if device.rack else "",
+    )
+
+
+def _vm_location_group(device):
+    """
+    Build the Location group for a vm, based on its Cluster.
+
+    :param device: A NetBox pynetbox.models.virtualization.VirtualMachines
+    :return Location group name
+    """
+
+    if device.cluster:
+        return "Location#All Locations{site}{rack}".format(
+            site=f"#{device.cluster.site.name}" if device.cluster.site else "",
+            rack=f"#VM Clusters#{ise_name_cleanup(device.cluster.name)}",
+        )
+    return "Location#All Locations{site}{rack}".format(
+        site=f"#{device.site.name}" if device.site else "",
+        rack=f"#VM Clusters#None",
+    )
+
+
+def _device_type_group(device):
+    """
+    Build the Device Type group for a device, based on its Device Type.
+
+    :param device: A NetBox pynetbox.models.dcim.Devices
+    :return Device Type group name
+    """
+
+    return "Device Type#All Device Types#{manufacturer}#{device_type}".format(
+        manufacturer=_GET_MANUF(device),
+        device_type=_GET_MODEL(device),
+    )
+
+
+def _vm_type_group(device):
+    """
+    Build the Device Type group for a vm, the same for every vm.
+
+    :param device: A NetBox pynetbox.models.virtualization.VirtualMachines
+    :return Device Type group name
+    """
+
+    return "Device Type#All Device Types#All VMs#General VM"
+
+
+def _device_role_group(device):
+    """
+    Build the Device Role group for a device, based on its Device Role.
+
+    :param device: A NetBox pynetbox.models.dcim.Devices
+    :return Device Role group name
+    """
+
+    return f"Device Role#Device Role#{ise_name_cleanup(_GET_ROLE(device))}"
+
+
+def _vm_role_group(device):
+    """
+    Build the Device Role group for a vm, based on its Role (if no role, the root group).
+
+    :param device: A NetBox pynetbox.models.virtualization.VirtualMachines
+    :return Device Role group name
+    """
+
+    if device.role:
+        return f"Device Role#Device Role#{ise_name_cleanup(device.role.name)}"
+    return "Device Role#Device Role"
+
+
+# (location, device type, role) group builders for each kind of NetBox object
+_GROUP_BUILDERS = {
+    "device": (_device_location_group, _device_type_group, _device_role_group),
+    "vm": (_vm_location_group, _vm_type_group, _vm_role_group),
+}
+
+
+def _device_group_key(device):
+    """
+    Return the NetBox names the device builders read. Devices with the same
+    names get the same groups.
+
+    :param device: A NetBox pynetbox.models.dcim.Devices
+    :return tuple of Site, Rack, Manufacturer, Device Type and Device Role names
+    """
+
+    rack = device.rack
+    return (
+        _GET_SITE(device),
+        rack.name if rack else None,
+        _GET_MANUF(device),
+        _GET_MODEL(device),
+        _GET_ROLE(device),
+    )
+
+
+def _vm_group_key(device):
+    """
+    Return the NetBox names the vm builders read. VMs with the same names get
+    the same groups.
+
+    :param device: A NetBox pynetbox.models.virtualization.VirtualMachines
+    :return tuple of Cluster, Site and Role names
+    """
+
+    cluster = device.cluster
+    if cluster:
+        site = cluster.site
+        location = (cluster.name, site.name if site else None)
+    else:
+        site = device.site
+        location = (None, site.name if site else None)
+    role = device.role
+    return (*location, role.name if role else None)
+
+
+_GROUP_KEYS = {"device": _device_group_key, "vm": _vm_group_key}
+
+# Groups already built, keyed by kind, the builder names and the tenant names
+_GROUP_CACHE = {}
+
+
+def _netbox_device_kind(device):
+    """
+    Determine whether a NetBox object is a device or a vm.
+
+    :param device: A NetBox pynetbox.models.dcim.Devices or pynetbox.models.virtualization.VirtualMachines
+    :return "device" or "vm"
+    """
+
+    return "device" if isinstance(device, pynetbox.models.dcim.Devices) else "vm"
+
+
+def ise_groups_from_netbox(device, debug=False, kind=None):
     """
     Given a device or vm from NetBox, create the ISE Groups list for device.
 
     :param device: A NetBox pynetbox.models.dcim.Devices or pynetbox.models.virtualization.VirtualMachines
+    :param kind: "device" or "vm" if already known, otherwise determined from device
     :return a list of groups for ISE
     """
 
-    groups = []
-
-    # Location Group
-    location_group = "Location#All Locations{site}{rack}"
-    # Devices: Based on Rack or Site
-    if isinstance(device, pynetbox.models.dcim.Devices):
-        location_group = location_group.format(
-            site=f"#{device.site.name}",
-            rack=f"#{ise_name_cleanup(device.rack.name)}" if device.rack else "",
-        )
-    # VMs: Based on Cluster
-    elif isinstance(device, pynetbox.models.virtualization.VirtualMachines):
-        if device.cluster:
-            location_group = location_group.format(
-                site=f"#{device.cluster.site.name}" if device.cluster.site else "",
-                rack=f"#VM Clusters#{ise_name_cleanup(device.cluster.name)}",
-            )
-        else:
-            location_group = location_group.format(
-                site=f"#{device.site.name}" if device.site else "",
-                rack=f"#VM Clusters#None",
+    if kind is None:
+        kind = _netbox_device_kind(device)
+
+    # NOTE: Each attribute read on a pynetbox record is a lookup, read them once
+    tenant = device.tenant
+    tenant_group = tenant.group if tenant else None
+    tenant_name = tenant.name if tenant else None
+    tenant_group_name = tenant_group.name if tenant_group else None
+
+    # Many devices share a site, rack, role and tenant. Build their groups once.
+    key = (kind, _GROUP_KEYS[kind](device), tenant_group_name, tenant_name)
+    groups = _GROUP_CACHE.get(key)
+    if groups is None:
+        groups = [build_group(device) for build_group in _GROUP_BUILDERS[kind]]
+
+        # Tenants
+        groups.append(
+            "Tenant#Tenant{tenant_group}{tenant}".format(
+                tenant_group=f"#{tenant_group_name}" if tenant_group else "",
+                tenant=f"#{tenant_name}" if tenant else "",
             )
-    groups.append(location_group)
-
-    # Device Type Group
-    device_type_group = "Device Type#All Device Types#{manufacturer}#{device_type}"
-    # Devices: Based on Device Type
-    if isinstance(device, pynetbox.models.dcim.Devices):
-        device_type_group = device_type_group.format(
-            manufacturer=device.device_type.manufacturer.name,
-            device_type=device.device_type.model,
-        )
-    # VMs: Based on VM Role (if no role, just VM)
-    elif isinstance(device, pynetbox.models.virtualization.VirtualMachines):
-        device_type_group = device_type_group.format(
-            manufacturer="All VMs", device_type="General VM"
         )
-    groups.append(device_type_group)
-
-    # Custom Groups
-    # Devices: Device Role
-    role_group = "Device Role#Device Role{role}"
-    if isinstance(device, pynetbox.models.dcim.Devices):
-        role_group = role_group.format(
-            role=f"#{ise_name_cleanup(device.device_role.name)}"
-        )
-    # VMs: VM Role
-    elif (
-        isinstance(device, pynetbox.models.virtualization.VirtualMachines)
-        and device.role
-    ):
-        role_group = role_group.format(role=f"#{ise_name_cleanup(device.role.name)}")
-    groups.append(role_group)
-
-    # Tenants
-    tenant_group = "Tenant#Tenant{tenant_group}{tenant}"
-    tenant_group = tenant_group.format(
-        tenant_group=f"#{device.tenant.group.name}"
-        if device.tenant and device.tenant.group
-        else "",
-        tenant=f"#{device.tenant.name}" if device.tenant else "",
-    )
-    groups.append(tenant_group)
 
-    # IPSEC Group
-    # TODO: Method to store IPSEC status in NetBox. For now hard coded to NO
-    ipsec_group = "IPSEC#Is IPSEC Device#No"
-    groups.append(ipsec_group)
+        # IPSEC Group
+        # TODO: Method to store IPSEC status in NetBox. For now hard coded to NO
+        ipsec_group = "IPSEC#Is IPSEC Device#No"
+        groups.append(ipsec_group)
 
-    return groups
+        _GROUP_CACHE[key] = groups
+
+    # Return a copy so changes made by the caller don't alter the cached groups
+    return list(groups)
 
 
 def set_of_ise_groups(ise_devices):
@@ -166,11 +285,9 @@ def set_of_ise_groups(ise_devices):
     :return set of ISE Network Device Groups
     """
 
-    ise_groups = []
-    for ise_device in ise_devices:
-        ise_groups += ise_device["NetworkDeviceGroupList"]
-
-    return set(ise_groups)
+    return set().union(
+        *(ise_device["NetworkDeviceGroupList"] for ise_device in ise_devices)
+    )
 
 
 def diff_ise_groups(desired_groups, current_groups, desired_description=""):
@@ -190,20 +307,19 @@ def diff_ise_groups(desired_groups, current_groups, desired_description=""):
         }
     """
 
-    set_current_groups = set(current_groups.keys())
-
-    missing_groups = desired_groups.difference(set_current_groups)
-    extra_groups = set_current_groups.difference(desired_groups)
-    existing_groups = desired_groups.intersection(set_current_groups)
+    # Compare the desired group names against the names configured in ISE
+    current_group_names = current_groups.keys()
 
-    correct_groups = set()
-    incorrect_groups = set()
+    missing_groups = desired_groups - current_group_names
+    extra_groups = current_group_names - desired_groups
+    existing_groups = desired_groups & current_group_names
 
-    for group in existing_groups:
-        if current_groups[group]["description"] != desired_description:
-            incorrect_groups.add(group)
-        else:
-            correct_groups.add(group)
+    incorrect_groups = {
+        group
+        for group in existing_groups
+        if current_groups[group]["description"] != desired_description
+    }
+    correct_groups = existing_groups - incorrect_groups
 
     return {
         "correct": correct_groups,
@@ -213,6 +329,88 @@ def diff_ise_groups(desired_groups, current_groups, desired_description=""):
     }
 
 
+# Fields not compared between current and desired devices
+# NOTE: Groups are excluded from diff as group changes are handled seperately
+_DEVICE_DIFF_EXCLUDE = frozenset(
+    {
+        "root['id']",
+        "root['link']",
+        "root['NetworkDeviceGroupList']",
+        "root['tacacsSettings']['previousSharedSecret']",
+        "root['tacacsSettings']['previousSharedSecretExpiry']",
+    }
+)
+
+
+def _collect_device_changes(current, desired, path, changes):
+    """
+    Record the differences between a current and desired value into changes.
+    Values that compare equal are skipped without walking into them.
+    """
+
+    if current == desired:
+        return
+
+    if isinstance(current, dict) and isinstance(desired, dict):
+        for key, value in desired.items():
+            key_path = f"{path}[{key!r}]"
+            if key_path in _DEVICE_DIFF_EXCLUDE:
+                continue
+            if key in current:
+                _collect_device_changes(current[key], value, key_path, changes)
+            else:
+                changes.setdefault("dictionary_item_added", []).append(key_path)
+        for key in current.keys() - desired.keys():
+            key_path = f"{path}[{key!r}]"
+            if key_path not in _DEVICE_DIFF_EXCLUDE:
+                changes.setdefault("dictionary_item_removed", []).append(key_path)
+
+    elif isinstance(current, list) and isinstance(desired, list):
+        for index, (current_item, desired_item) in enumerate(zip(current, desired)):
+            _collect_device_changes(
+                current_item, desired_item, f"{path}[{index}]", changes
+            )
+        if len(desired) > len(current):
+            added = changes.setdefault("iterable_item_added", {})
+            for index in range(len(current), len(desired)):
+                added[f"{path}[{index}]"] = desired[index]
+        elif len(current) > len(desired):
+            removed = changes.setdefault("iterable_item_removed", {})
+            for index in range(len(desired), len(current)):
+                removed[f"{path}[{index}]"] = current[index]
+
+    elif type(current) is not type(desired):
+        changes.setdefault("type_changes", {})[path] = {
+            "old_type": type(current),
+            "new_type": type(desired),
+            "old_value": current,
+            "new_value": desired,
+        }
+
+    else:
+        changes.setdefault("values_changed", {})[path] = {
+            "new_value": desired,
+            "old_value": current,
+        }
+
+
+def ise_device_changes(current, desired):
+    """
+    Compare a current ISE device configuration to the desired configuration.
+
+    The differences are reported in the same layout DeepDiff uses, ie
+    {"values_changed": {"root['description']": {"new_value": "", "old_value": ""}}}
+
+    :param current: A dictionary of the ISE device configuration currently configured in ISE
+    :param desired: A dictionary of the ISE device configuration desired to be configured in ISE
+    :return changes dictionary, empty if the device is correct
+    """
+
+    changes = {}
+    _collect_device_changes(current, desired, "root", changes)
+    return changes
+
+
 def diff_ise_devices(desired_devices, current_devices, debug=False):
     """
     Given a list of desired device definitions for ISE and the current ISE
@@ -241,50 +439,27 @@ def diff_ise_devices(desired_devices, current_devices, debug=False):
     # 'enableMultiSecret': 'false'}
     # Rather than having NO key for 'authenticationSettings' (like an unconfigured TACACS)
     # we need to manually remove this key to provide an accurate diff check.
-    for device in current_devices:
-        if not "radiusSharedSecret" in current_devices[device][
-            "authenticationSettings"
-        ].keys() or (
-            current_devices[device]["authenticationSettings"]["radiusSharedSecret"]
-            == ""
-            and not "networkProtocol"
-            in current_devices[device]["authenticationSettings"].keys()
+    for device, current in current_devices.items():
+        auth = current.get("authenticationSettings")
+        if auth is None:
+            continue
+        if "radiusSharedSecret" not in auth or (
+            auth["radiusSharedSecret"] == "" and "networkProtocol" not in auth
         ):
             if debug:
                 print(
                     f'Removing "authenticationSettings" key from current {device} to reflect unconfigured RADIUS'
                 )
 
-            del current_devices[device]["authenticationSettings"]
-
-    # Working data structure for updates
-    working = {
-        desired["name"]: {
-            "desired": desired,
-            "current": None,
-            "changes": None,
-            "group_changes": None,
-        }
-        for desired in desired_devices.values()
-    }
-
-    # Initial set check
-    set_desired_device_names = set(desired_devices.keys())
-    set_current_device_names = set(current_devices.keys())
-
-    set_names_exist = set_desired_device_names.intersection(set_current_device_names)
-    if debug:
-        print(f"set_names_exist: {set_names_exist}")
-    for device in set_names_exist:
-        working[device]["current"] = current_devices[device]
+            del current["authenticationSettings"]
 
-    set_names_missing = set_desired_device_names.difference(set_current_device_names)
     if debug:
-        print(f"set_names_missing: {set_names_missing}")
-
-    set_names_extra = set_current_device_names.difference(set_desired_device_names)
-    if debug:
-        print(f"set_names_extra: {set_names_missing}")
+        # Devices matched by name, only in NetBox, and only in ISE
+        desired_device_names = desired_devices.keys()
+        current_device_names = current_devices.keys()
+        print(f"set_names_exist: {desired_device_names & current_device_names}")
+        print(f"set_names_missing: {desired_device_names - current_device_names}")
+        print(f"set_names_extra: {current_device_names - desired_device_names}")
 
     # IP Address Based Checks
     # Get list of currently configured IP addresses
@@ -293,64 +468,59 @@ def diff_ise_devices(desired_devices, current_devices, debug=False):
         for device in current_devices.values()
     }
 
-    # For each desired_device, see if there is a current_device with the same IP address
+    results = {"correct": {}, "incorrect": {}, "missing": {}, "extra": {}}
+
+    # Match, compare and classify each desired device in a single pass
     for desired in desired_devices.values():
-        if desired["NetworkDeviceIPList"][0]["ipaddress"] in current_ips.keys():
-            if debug:
-                print(
-                    f'desired_device {desired["name"]}s IP of {desired["NetworkDeviceIPList"][0]["ipaddress"]} is already used by current_device {current_ips[desired["NetworkDeviceIPList"][0]["ipaddress"]]["name"]}'
-                )
+        name = desired["name"]
+        desired_groups = set(desired["NetworkDeviceGroupList"])
+
+        # Find the current_device with the same name, or failing that the
+        # current_device already using the same IP address
+        ip_address = desired["NetworkDeviceIPList"][0]["ipaddress"]
+        current = current_devices.get(name) or current_ips.get(ip_address)
+
+        if not current:
+            results["missing"][name] = {
+                "desired": desired,
+                "current": None,
+                "changes": None,
+                "group_changes": {
+                    "correct": set(),
+                    "missing": desired_groups,
+                    "extra": set(),
+                },
+            }
+            continue
 
-            working[desired["name"]]["current"] = current_ips[
-                desired["NetworkDeviceIPList"][0]["ipaddress"]
-            ]
-
-    # Figure out changes needed
-    # NOTE: Groups are excluded from diff as group changes are handled seperately
-    for device in working.values():
-        if device["current"]:
-            device["changes"] = DeepDiff(
-                device["current"],
-                device["desired"],
-                exclude_paths=[
-                    "root['id']",
-                    "root['link']",
-                    "root['NetworkDeviceGroupList']",
-                    "root['tacacsSettings']['previousSharedSecret']",
-                    "root['tacacsSettings']['previousSharedSecretExpiry']",
-                ],
+        if debug and name not in current_devices:
+            print(
+                f'desired_device {name}s IP of {ip_address} is already used by current_device {current["name"]}'
             )
-            current_groups = set(device["current"]["NetworkDeviceGroupList"])
-        else:
-            current_groups = set()
-
-        # Update with group updates needed
-        desired_groups = set(device["desired"]["NetworkDeviceGroupList"])
 
-        device["group_changes"] = {
-            "correct": desired_groups.intersection(current_groups),
-            "missing": desired_groups.difference(current_groups),
-            "extra": current_groups.difference(desired_groups),
+        # Figure out changes needed
+        # NOTE: Groups are compared seperately from the other fields
+        current_groups = set(current["NetworkDeviceGroupList"])
+        info = {
+            "desired": desired,
+            "current": current,
+            "changes": ise_device_changes(current, desired),
+            "group_changes": {
+                "correct": desired_groups & current_groups,
+                "missing": desired_groups - current_groups,
+                "extra": current_groups - desired_groups,
+            },
         }
 
-    results = {"correct": {}, "incorrect": {}, "missing": {}, "extra": {}}
-
-    for device, info in working.items():
         # Which devices need updates
-        # The logic in this is likely an area for possible improvement, but it works
-        if info["changes"]:
-            results["incorrect"][device] = info
+        if (
+            info["changes"]
+            or info["group_changes"]["missing"]
+            or info["group_changes"]["extra"]
+        ):
+            results["incorrect"][name] = info
         else:
-            if not info["current"]:
-                results["missing"][device] = info
-            else:
-                if (
-                    info["group_changes"]["missing"] != set()
-                    or info["group_changes"]["extra"] != set()
-                ):
-                    results["incorrect"][device] = info
-                else:
-                    results["correct"][device] = info
+            results["correct"][name] = info
 
     # TODO: How to find/determine "extra" devices
     #   must consider name changes...
@@ -3,28 +3,123 @@ This is a set of Cisco ISE related functions used to retrieve and update data
 """
 
 from pyiseers import ERS
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from math import ceil
 import traceback
 
 
-def verify_ise(ise_server):
+@lru_cache(maxsize=8)
+def _get_ers(address, username, password):
     """
-    Verify an ISE Server is reachable
+    Return an ERS client for an ISE Server, reusing one already created for the
+    same server and credentials so its session (and TLS connection) is shared.
 
-    :param ise_server: A dictionary {"address": "192.168.0.11", "username": "admin", "password": "password"}
-    :return status dictionary
+    :param address: ISE Server address
+    :param username: ERS username
+    :param password: ERS password
+    :return ERS client
     """
 
     ise = ERS(
-        ise_node=ise_server["address"],
-        ers_user=ise_server["username"],
-        ers_pass=ise_server["password"],
+        ise_node=address,
+        ers_user=username,
+        ers_pass=password,
         verify=False,
         disable_warnings=True,
         timeout=10,
     )
 
+    # Device lookups and syncs send requests from several threads at once. Size the
+    # session's connection pool so those connections are kept and reused, rather
+    # than discarded once the default pool of 10 is full.
+    # Requests ISE rejects while busy are retried with a backoff. POST isn't retried
+    # by default, so a device or group is never created twice. Connection, read and
+    # other errors (ie a failed TLS handshake) aren't retried and are raised on the
+    # first failure. Once the retries are used up the last response is returned for
+    # pyiseers to handle as before.
+    retries = Retry(
+        total=3,
+        connect=0,
+        read=0,
+        other=0,
+        status=3,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        raise_on_status=False,
+    )
+    ise.ise.mount(
+        "https://",
+        HTTPAdapter(pool_connections=20, pool_maxsize=32, max_retries=retries),
+    )
+
+    return ise
+
+
+def _get_pages(list_function, page_size, max_workers=4, debug=False):
+    """
+    Page through an ERS list function (ie ise.get_devices), yielding the response
+    for each page in order. Stops after the last page or the first unsuccessful
+    response.
+
+    :param list_function: ERS method accepting size and page arguments
+    :param page_size: Number of items to request per page
+    :param max_workers: Number of pages to request from ISE concurrently (default 4)
+    :return generator of ERS response dictionaries
+    """
+
+    def get_page(page):
+        if debug:
+            print(
+                f"Sending ise.{list_function.__name__}(size = {page_size}, page = {page})"
+            )
+        return list_function(size=page_size, page=page)
+
+    # The first page provides the total, the remaining pages are then requested together
+    response = get_page(1)
+    if debug:
+        print(response)
+    yield response
+    if not response["success"]:
+        return
+
+    pages = ceil(int(response["total"]) / page_size)
+    if pages <= 1:
+        return
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = [executor.submit(get_page, page) for page in range(2, pages + 1)]
+        try:
+            for request in pending:
+                response = request.result()
+                if debug:
+                    print(response)
+                yield response
+                if not response["success"]:
+                    return
+        finally:
+            # Don't wait on pages that are no longer needed
+            for request in pending:
+                request.cancel()
+
+
+def verify_ise(ise_server):
+    """
+    Verify an ISE Server is reachable
+
+    :param ise_server: A dictionary {"address": "192.168.0.11", "username": "admin", "password": "password"}
+    :return status dictionary
+    """
+
+    ise = _get_ers(
+        ise_server["address"], ise_server["username"], ise_server["password"]
+    )
+
     try:
-        devices = ise.get_devices()["response"]
+        # Only checking the connection and credentials, a single device is enough
+        devices = ise.get_devices(size=1)["response"]
         if isinstance(devices, str) and devices == "Unauthorized":
             return {"status": False, "message": f"Unable to authenticate to Cisco ISE"}
         elif isinstance(devices, list):
@@ -41,41 +136,26 @@ def verify_ise(ise_server):
         }
 
 
-def lookup_groups(ise_server, debug=False):
+def lookup_groups(ise_server, debug=False, page_size=100):
     """
     Retrive the Network Device Groups configured on the ISE Server
 
     :param ise_server: A dictionary {"address": "192.168.0.11", "username": "admin", "password": "password"}
+    :param page_size: Number of groups to request from ISE per page, ERS allows up to 100 (default 100)
     """
 
-    ise = ERS(
-        ise_node=ise_server["address"],
-        ers_user=ise_server["username"],
-        ers_pass=ise_server["password"],
-        verify=False,
-        disable_warnings=True,
-        timeout=10,
+    ise = _get_ers(
+        ise_server["address"], ise_server["username"], ise_server["password"]
     )
 
     # dictionary to hold groups
     ise_groups = {}
 
-    # paging variables for lookup
-    size, page = 20, 0
-    while page == 0 or (response["total"] > page * size):
-        page += 1
-        if debug:
-            print(f"Sending ise.get_device_groups(size = {size}, page = {page})")
-        response = ise.get_device_groups(size=size, page=page)
-        if response["success"]:
-            if debug:
-                print(response)
-            for group in response["response"]:
-                ise_groups[group[0]] = {"id": group[1], "description": group[2]}
-        else:
-            if debug:
-                print(response)
+    for response in _get_pages(ise.get_device_groups, page_size, debug=debug):
+        if not response["success"]:
             return False
+        for name, group_id, description in response["response"]:
+            ise_groups[name] = {"id": group_id, "description": description}
 
     return ise_groups
 
@@ -92,6 +172,7 @@ def sync_groups(
     Sync the Network Device Groups configured on the ISE Server
 
     :param ise_server: A dictionary {"address": "192.168.0.11", "username": "admin", "password": "password"}
+        An optional "max_workers" key limits how many changes are sent to ISE concurrently (default 8)
     :param current_groups: A dictionary of current ISE groups. {"group#name": {"id": "", "description": ""}}
     :param group_diff: A diff dictionary of group changes needed
         {
@@ -106,38 +187,64 @@ def sync_groups(
 
     results = {"updated": {}, "created": {}, "deleted": {}}
 
-    ise = ERS(
-        ise_node=ise_server["address"],
-        ers_user=ise_server["username"],
-        ers_pass=ise_server["password"],
-        verify=False,
-        disable_warnings=True,
-        timeout=10,
+    # Nothing to change in ISE, skip setting up the client
+    if not (
+        group_diff["incorrect"]
+        or group_diff["missing"]
+        or (remove_extra and group_diff["extra"])
+    ):
+        if debug:
+            print("All groups are correct. No changes to be made.")
+        return results
+
+    ise = _get_ers(
+        ise_server["address"], ise_server["username"], ise_server["password"]
     )
 
-    for group in group_diff["correct"]:
-        if debug:
+    if debug:
+        for group in group_diff["correct"]:
             print(f"Group {group} is correct. No changes to be made.")
 
-    for group in group_diff["incorrect"]:
-        if debug:
-            print(f"Group {group} is incorrect. Updating group.")
-        results["updated"][group] = ise.update_device_group(
-            device_group_oid=current_groups[group]["id"], description=description
-        )
+    with ThreadPoolExecutor(max_workers=ise_server.get("max_workers", 8)) as executor:
+        updates = {}
+        for group in group_diff["incorrect"]:
+            if debug:
+                print(f"Group {group} is incorrect. Updating group.")
+            updates[
+                executor.submit(
+                    ise.update_device_group,
+                    device_group_oid=current_groups[group]["id"],
+                    description=description,
+                )
+            ] = group
+
+        # A group can only be created once its parent exists, so missing groups
+        # are created one level of the group hierarchy at a time. The updates
+        # above don't depend on these and keep running in the meantime.
+        for depth in sorted({group.count("#") for group in group_diff["missing"]}):
+            creates = {}
+            for group in group_diff["missing"]:
+                if group.count("#") != depth:
+                    continue
+                if debug:
+                    print(f"Group {group} is missing. It will be created.")
+                creates[
+                    executor.submit(
+                        ise.add_device_group, name=group, description=description
+                    )
+                ] = group
+            for create in as_completed(creates):
+                results["created"][creates[create]] = create.result()
 
-    for group in group_diff["missing"]:
-        if debug:
-            print(f"Group {group} is missing. It will be created.")
-        results["created"][group] = ise.add_device_group(
-            name=group, description=description
-        )
+        for update in as_completed(updates):
+            results["updated"][updates[update]] = update.result()
 
     if remove_extra:
-        for group in group_diff["extra"]:
-            if debug:
+        # NOTE: Removing groups is not enabled yet, the loop only reports extra groups
+        if debug:
+            for group in group_diff["extra"]:
                 print(f"Group {group} is 'extra'. It will be removed.")
-            # results["deleted"][group] = ise.delete_device_group(name=group)
+                # results["deleted"][group] = ise.delete_device_group(name=group)
 
     else:
         if debug:
@@ -146,49 +253,51 @@ def sync_groups(
     return results
 
 
-def lookup_ise_devices(ise_server, debug=False):
+def lookup_ise_devices(ise_server, debug=False, max_workers=16, page_size=100):
     """
     Retrieve the Network Devices from ISE
 
     :param ise_server: A dictionary {"address": "192.168.0.11", "username": "admin", "password": "password"}
+    :param max_workers: Number of device details to lookup from ISE concurrently (default 16)
+    :param page_size: Number of devices to request from ISE per page, ERS allows up to 100 (default 100)
     :return a results dictionary with device name as key and ISE config as value
     """
 
-    ise = ERS(
-        ise_node=ise_server["address"],
-        ers_user=ise_server["username"],
-        ers_pass=ise_server["password"],
-        verify=False,
-        disable_warnings=True,
-        timeout=10,
+    ise = _get_ers(
+        ise_server["address"], ise_server["username"], ise_server["password"]
     )
 
     # dictionary to hold devices
     ise_devices = {}
 
-    # paging variables for lookup
-    size, page = 20, 0
-    while page == 0 or (response["total"] > page * size):
-        page += 1
-        if debug:
-            print(f"Sending ise.get_devices(size = {size}, page = {page})")
-        response = ise.get_devices(size=size, page=page)
-        if response["success"]:
-            if debug:
-                print(response)
-            for device in response["response"]:
+    # Device details are looked up one request per device, run them concurrently.
+    # Lookups for a page start while the next page is being retrieved.
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        lookups = {}
+        for response in _get_pages(ise.get_devices, page_size, debug=debug):
+            if not response["success"]:
+                return False
+            for name, device_id in response["response"]:
                 if debug:
                     print(
-                        f"Looking up network device details from ISE for device name {device[0]}"
+                        f"Looking up network device details from ISE for device name {name}"
                     )
-                ise_device = ise.get_device(device=device[0])
-                if debug:
-                    print(ise_device)
-                ise_devices[device[0]] = ise_device["response"]
-        else:
+                # The list response already includes the device id. Requesting the
+                # device by id skips the name search that ise.get_device() sends first.
+                lookups[
+                    executor.submit(
+                        ise.get_object,
+                        f"{ise.url_base}/config/networkdevice/",
+                        device_id,
+                        "NetworkDevice",
+                    )
+                ] = name
+
+        for lookup in as_completed(lookups):
+            ise_device = lookup.result()
             if debug:
-                print(response)
-            return False
+                print(ise_device)
+            ise_devices[lookups[lookup]] = ise_device["response"]
 
     return ise_devices
 
@@ -203,6 +312,7 @@ def sync_devices(
     Sync the Network Devices configured on the ISE Server
 
     :param ise_server: A dictionary {"address": "192.168.0.11", "username": "admin", "password": "password"}
+        An optional "max_workers" key limits how many changes are sent to ISE concurrently (default 8)
     :param current_groups: A dictionary of current ISE groups. {"group#name": {"id": "", "description": ""}}
     :param devices_diff: A diff dictionary of device changes needed
         {
@@ -216,35 +326,58 @@ def sync_devices(
 
     results = {"updated": {}, "created": {}, "deleted": {}}
 
-    ise = ERS(
-        ise_node=ise_server["address"],
-        ers_user=ise_server["username"],
-        ers_pass=ise_server["password"],
-        verify=False,
-        disable_warnings=True,
-        timeout=10,
+    # Nothing to change in ISE, skip setting up the client
+    if not (
+        devices_diff["incorrect"]
+        or devices_diff["missing"]
+        or (remove_extra and devices_diff["extra"])
+    ):
+        if debug:
+            print("All devices are correct. No changes to be made.")
+        return results
+
+    ise = _get_ers(
+        ise_server["address"], ise_server["username"], ise_server["password"]
     )
 
-    for device in devices_diff["correct"]:
-        if debug:
+    if debug:
+        for device in devices_diff["correct"]:
             print(f"Device {device} is correct. No changes to be made.")
 
-    for device, diff_details in devices_diff["incorrect"].items():
-        if debug:
-            print(f"Device {device} is incorrect. Updating device.")
-        # Update the device using the current.name
-        results["updated"][device] = ise.update_device(
-            name=diff_details["current"]["name"], device_payload=diff_details["desired"]
-        )
-        if debug:
-            print(results["updated"][device])
-
-    for device, diff_details in devices_diff["missing"].items():
-        if debug:
-            print(f"Device {device} is missing. It will be created.")
-        results["created"][device] = ise.add_device(
-            device_payload=diff_details["desired"]
-        )
+    with ThreadPoolExecutor(max_workers=ise_server.get("max_workers", 8)) as executor:
+        changes = {}
+        # Queue the larger bucket first so more of the requests get started sooner
+        for bucket in sorted(
+            ("incorrect", "missing"),
+            key=lambda bucket: len(devices_diff[bucket]),
+            reverse=True,
+        ):
+            for device, diff_details in devices_diff[bucket].items():
+                if bucket == "incorrect":
+                    if debug:
+                        print(f"Device {device} is incorrect. Updating device.")
+                    # Update the device using the current.name
+                    changes[
+                        executor.submit(
+                            ise.update_device,
+                            name=diff_details["current"]["name"],
+                            device_payload=diff_details["desired"],
+                        )
+                    ] = ("updated", device)
+                else:
+                    if debug:
+                        print(f"Device {device} is missing. It will be created.")
+                    changes[
+                        executor.submit(
+                            ise.add_device, device_payload=diff_details["desired"]
+                        )
+                    ] = ("created", device)
+
+        for change in as_completed(changes):
+            status, device = changes[change]
+            results[status][device] = change.result()
+            if debug and status == "updated":
+                print(results["updated"][device])
 
     if remove_extra:
         for device in devices_diff["extra"]:
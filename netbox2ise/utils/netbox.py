@@ -3,6 +3,7 @@ This is a set of NetBox related functions used to retrieve data from NetBox
 """
 
 import pynetbox
+from concurrent.futures import ThreadPoolExecutor
 from requests import exceptions
 from pynetbox.core.query import RequestError
 
@@ -34,11 +35,12 @@ def verify_netbox(netbox_server):
     return {"status": True, "message": status_message}
 
 
-def query_netbox(object, debug=False, **query):
+def query_netbox(object, debug=False, materialize=True, **query):
     """
     Generic function to send a filter query to NetBox for an object
 
     :param object: A reference to a pynetbox object. Example nb.dcim.device_types
+    :param materialize: Return a list rather than the pynetbox RecordSet (default True)
     :param **query: A dictionary of key/values to filter results
     :return results from NetBox
     """
@@ -51,6 +53,10 @@ def query_netbox(object, debug=False, **query):
 
     # Note: Converting the returned `RecordSet` to a list to support code that
     # loops over and access the returned set of data more than once.
+    # Code that loops over the results only once can use the `RecordSet` as is,
+    # pynetbox then requests each page of results as the loop reaches it.
+    if not materialize:
+        return results
     return list(results)
 
 
@@ -83,46 +89,50 @@ def lookup_nb_devices(
         device_query = {}
         vm_query = {}
 
+        # The filter lookups don't depend on each other, send them to NetBox together
+        to_resolve = {}
         if len(sites) > 0:
-            sites = query_netbox(
-                object=nb.dcim.sites, debug=debug, name=[site for site in sites]
-            )
-            device_query["site_id"] = [site.id for site in sites]
-            vm_query["site_id"] = [site.id for site in sites]
-
+            to_resolve["sites"] = (nb.dcim.sites, {"name": sites})
         if len(device_types) > 0:
-            device_types = query_netbox(
-                object=nb.dcim.device_types,
-                debug=debug,
-                model=[device_type for device_type in device_types],
+            to_resolve["device_types"] = (nb.dcim.device_types, {"model": device_types})
+        if len(device_roles) > 0:
+            to_resolve["device_roles"] = (nb.dcim.device_roles, {"name": device_roles})
+            to_resolve["vm_roles"] = (
+                nb.dcim.device_roles,
+                {"name": device_roles, "vm_role": True},
             )
+        if len(tenants) > 0:
+            to_resolve["tenants"] = (nb.tenancy.tenants, {"name": tenants})
+
+        resolved = {}
+        if to_resolve:
+            with ThreadPoolExecutor(max_workers=len(to_resolve)) as executor:
+                lookups = {
+                    key: executor.submit(
+                        query_netbox, object=object, debug=debug, **query
+                    )
+                    for key, (object, query) in to_resolve.items()
+                }
+                resolved = {key: lookup.result() for key, lookup in lookups.items()}
+
+        if "sites" in resolved:
+            device_query["site_id"] = [site.id for site in resolved["sites"]]
+            vm_query["site_id"] = [site.id for site in resolved["sites"]]
+
+        if "device_types" in resolved:
             device_query["device_type_id"] = [
-                device_type.id for device_type in device_types
+                device_type.id for device_type in resolved["device_types"]
             ]
 
-        if len(device_roles) > 0:
-            device_roles = query_netbox(
-                object=nb.dcim.device_roles,
-                debug=debug,
-                name=[device_role for device_role in device_roles],
-            )
-            device_query["role_id"] = [device_role.id for device_role in device_roles]
-            vm_roles = query_netbox(
-                object=nb.dcim.device_roles,
-                debug=debug,
-                name=[device_role for device_role in device_roles],
-                vm_role=True,
-            )
-            vm_query["role_id"] = [vm_role.id for vm_role in vm_roles]
+        if "device_roles" in resolved:
+            device_query["role_id"] = [
+                device_role.id for device_role in resolved["device_roles"]
+            ]
+            vm_query["role_id"] = [vm_role.id for vm_role in resolved["vm_roles"]]
 
-        if len(tenants) > 0:
-            tenants = query_netbox(
-                object=nb.tenancy.tenants,
-                debug=debug,
-                name=[tenant for tenant in tenants],
-            )
-            device_query["tenant_id"] = [tenant.id for tenant in tenants]
-            vm_query["tenant_id"] = [tenant.id for tenant in tenants]
+        if "tenants" in resolved:
+            device_query["tenant_id"] = [tenant.id for tenant in resolved["tenants"]]
+            vm_query["tenant_id"] = [tenant.id for tenant in resolved["tenants"]]
 
         if len(status) > 0:
             device_query["status"] = status
@@ -131,15 +141,27 @@ def lookup_nb_devices(
         device_query["has_primary_ip"] = has_primary_ip
         vm_query["has_primary_ip"] = has_primary_ip
 
+        # The rendered config context is often the largest part of a device or vm
+        # record, and isn't used to build the ISE configuration
+        device_query["exclude"] = "config_context"
+        vm_query["exclude"] = "config_context"
+
         if debug:
             print(f"device_query: {device_query}")
             print(f"vm_query: {vm_query}")
 
-        devices = query_netbox(object=nb.dcim.devices, debug=debug, **device_query)
+        # The devices and vms are only looped over once, when converting them for
+        # ISE, so they are streamed from NetBox rather than collected into lists
+        devices = query_netbox(
+            object=nb.dcim.devices, debug=debug, materialize=False, **device_query
+        )
         # Only query VMs if at least one role is listed
-        if len(vm_query["role_id"]) > 0:
+        if vm_query.get("role_id"):
             vms = query_netbox(
-                object=nb.virtualization.virtual_machines, debug=debug, **vm_query
+                object=nb.virtualization.virtual_machines,
+                debug=debug,
+                materialize=False,
+                **vm_query,
             )
         else:
             if debug: